@@ -4,6 +4,9 @@ import numpy as np
 import matplotlib.pyplot as plt
 from datetime import datetime
 import io
+import threading
+import time
+import uuid
 import smtplib
 from email.mime.multipart import MIMEMultipart
 from email.mime.text import MIMEText
@@ -25,140 +28,398 @@ if 'df2' not in st.session_state:
 if 'processed' not in st.session_state:
     st.session_state.processed = False
 
-# Title
-st.title("Warehouse Stock Analysis Dashboard")
+# Days categories
+days_bins = [-np.inf, 15, 30, 60, 90, 180, np.inf]
+days_labels = ["0 - 15 days", "16 - 30 days", "31 - 60 days", "61 - 90 days", "91 - 180 days", "180+ days"]
 
-# File upload section
-col1, col2 = st.columns(2)
-with col1:
-    stock_source_file = st.file_uploader("Upload Stock Source File", type=['xlsx'])
-with col2:
-    fabric_stock_file = st.file_uploader("Upload Fabric Stock File", type=['xlsx'])
+# Statistical significance (z above 30 items, t table up to 30 items)
+z_values = {90: 1.645, 95: 1.96, 99: 2.576}
 
-# Process data when files are uploaded
-if stock_source_file and fabric_stock_file and not st.session_state.processed:
-    with st.spinner("Processing data..."):
-        # Read files
-        df = pd.read_excel(stock_source_file, engine='openpyxl', sheet_name='Sheet')
-        df2 = pd.read_excel(fabric_stock_file, engine='openpyxl', sheet_name='Sheet')
-        
-        # Extract current date from fabric stock filename
-        fabric_filename = fabric_stock_file.name
-        try:
-            date_part = fabric_filename.split('stock')[1].split('.')[0].strip()
-            current_date = date_part.replace(' ', '-')
-        except:
-            current_date = datetime.now().strftime('%d-%m-%Y')
-        
-        # Aggregate by Warehouse
-        df_group1 = df.groupby('Warehouse')['Quantity'].sum().reset_index()
-        df2["one"] = 1
-        df_group2 = df2.groupby('Ware House')['one'].sum().reset_index()
-        
-        # Add PF_Active row
-        df_group1 = pd.concat([df_group1, df_group2[df_group2['Ware House'] == 'PF_Active'].rename(columns={'Ware House': 'Warehouse', 'one': 'Quantity'})], ignore_index=True)
-        df_grouped = df_group1
-        
-        # Warehouse order
-        warehouses = {'G_Active_1': 11, 'G_Active_2': 12, 'G_MD_1': 13, 'G_MD_2': 14, 
-                      'HGBU_Extra': 18, 'Pre_Ship_1': 15, 'Pre_Ship_2': 16, 'WIPLines1': 9, 
-                      'WIPLines2': 10, 'WIP_Cut_1': 2, 'WIP_Emb_1': 17, 'WIP_P1': 4, 
-                      'WIP_Pri_1': 3, 'WIP_Sew_1': 5, 'WIP_Sew_2': 6, 'WIP_Sew_P1': 7, 
-                      'WIP_Sew_P2': 8, 'PF_Active': 1}
-        
-        df_grouped['Order'] = df_grouped['Warehouse'].map(warehouses)
-        df_grouped = df_grouped.sort_values(by='Order').reset_index(drop=True)
-        
-        # Calculate number of days
-        df["number of days"] = (pd.to_datetime(current_date, format='%d-%m-%Y') - pd.to_datetime(df['Last Movement Date'], format='%d-%m-%Y')).dt.days
-        df2["number of days"] = (pd.to_datetime(current_date, format='%d-%m-%Y') - pd.to_datetime(df2['last transaction date'], format='%d-%m-%Y')).dt.days
-        
-        # Days categories
-        df["days cat"] = pd.cut(df["number of days"], bins=[-np.inf, 15, 30, 60, 90, 180, np.inf], 
-                                labels=["0 - 15 days", "16 - 30 days", "31 - 60 days", "61 - 90 days", "91 - 180 days", "180+ days"])
-        df2["days cat"] = pd.cut(df2["number of days"], bins=[-np.inf, 15, 30, 60, 90, 180, np.inf], 
-                                 labels=["0 - 15 days", "16 - 30 days", "31 - 60 days", "61 - 90 days", "91 - 180 days", "180+ days"])
-        
-        # Statistical significance
-        t_95_table = {2: 4.303, 3: 3.182, 4: 2.776, 5: 2.571, 6: 2.447, 7: 2.365, 8: 2.306, 
-                      9: 2.262, 10: 2.228, 11: 2.201, 12: 2.179, 13: 2.160, 14: 2.145, 15: 2.131, 
-                      16: 2.120, 17: 2.110, 18: 2.101, 19: 2.093, 20: 2.086, 21: 2.080, 22: 2.074, 
-                      23: 2.069, 24: 2.064, 25: 2.060, 26: 2.056, 27: 2.052, 28: 2.048, 29: 2.045, 30: 2.042}
-        
-        statistical_sig = {}
-        for i in df["Warehouse"].unique():
-            temp_df = df[df["Warehouse"] == i]
-            mean = temp_df["number of days"].mean()
-            sigma = temp_df["number of days"].std()
-            if len(temp_df) > 30:
-                CI_pos = mean + 1.96 * (sigma / np.sqrt(len(temp_df)))
-            else:
-                CI_pos = mean + t_95_table[len(temp_df)] * (sigma / np.sqrt(len(temp_df)))
-            statistical_sig[i] = CI_pos
-        
-        statistical_sig2 = {}
-        for i in df2["Ware House"].unique():
-            temp_df = df2[df2["Ware House"] == i]
-            mean = temp_df["number of days"].mean()
-            sigma = temp_df["number of days"].std()
-            if len(temp_df) > 30:
-                CI_pos = mean + 1.96 * (sigma / np.sqrt(len(temp_df)))
-            else:
-                CI_pos = mean + t_95_table[len(temp_df)] * (sigma / np.sqrt(len(temp_df)))
-            statistical_sig2[i] = CI_pos
-        
-        df["Critical"] = df["number of days"] > df["Warehouse"].map(statistical_sig)
-        df2["Critical"] = df2["number of days"] > df2["Ware House"].map(statistical_sig2)
-        
-        # Pivot tables
-        pivot_table = pd.pivot_table(df, values='Quantity', index='Warehouse', columns='days cat', aggfunc='sum', fill_value=0)
-        pivot_table2 = pd.pivot_table(df2, values='one', index='Ware House', columns='days cat', aggfunc='sum', fill_value=0)
-        
-        pivot_table = pd.concat([pivot_table, pivot_table2.loc[['PF_Active']].rename(index={'PF_Active': 'PF_Active'})], axis=0).fillna(0)
-        pivot_table['Order'] = pivot_table.index.map(warehouses)
-        pivot_table = pivot_table.sort_values(by='Order').drop(columns=['Order'])
-        
-        # Time category totals
-        time_cat_totals = df.groupby('days cat')['Quantity'].sum().reset_index()
-        
-        # Critical totals
-        crucial_totals = df[df['Critical']].groupby('Warehouse')['Quantity'].sum().reset_index()
-        
-        # Add PF_Active critical totals from df2
-        if 'PF_Active' in df2['Ware House'].unique():
-            pf_critical = df2[(df2['Ware House'] == 'PF_Active') & (df2['Critical'])].groupby('Ware House')['one'].sum().reset_index()
-            if not pf_critical.empty:
-                pf_critical.columns = ['Warehouse', 'Quantity']
-                crucial_totals = pd.concat([crucial_totals, pf_critical], ignore_index=True)
-        
-        crucial_totals['Order'] = crucial_totals['Warehouse'].map(warehouses)
-        crucial_totals = crucial_totals.sort_values(by='Order').drop(columns=['Order']).reset_index(drop=True)
-        
-        # Store in session state
-        st.session_state.df = df
-        st.session_state.df2 = df2
-        st.session_state.df_grouped = df_grouped
-        st.session_state.pivot_table = pivot_table
-        st.session_state.time_cat_totals = time_cat_totals
-        st.session_state.crucial_totals = crucial_totals
-        st.session_state.current_date = current_date
-        st.session_state.processed = True
-        st.rerun()
+t_90_table = {2: 2.920, 3: 2.353, 4: 2.132, 5: 2.015, 6: 1.943, 7: 1.895, 8: 1.860,
+              9: 1.833, 10: 1.812, 11: 1.796, 12: 1.782, 13: 1.771, 14: 1.761, 15: 1.753,
+              16: 1.746, 17: 1.740, 18: 1.734, 19: 1.729, 20: 1.725, 21: 1.721, 22: 1.717,
+              23: 1.714, 24: 1.711, 25: 1.708, 26: 1.706, 27: 1.703, 28: 1.701, 29: 1.699, 30: 1.697}
 
-# Main dashboard
-if st.session_state.processed:
-    df = st.session_state.df
-    df2 = st.session_state.df2
-    df_grouped = st.session_state.df_grouped
-    pivot_table = st.session_state.pivot_table
-    time_cat_totals = st.session_state.time_cat_totals
-    crucial_totals = st.session_state.crucial_totals
-    current_date = st.session_state.current_date
+t_95_table = {2: 4.303, 3: 3.182, 4: 2.776, 5: 2.571, 6: 2.447, 7: 2.365, 8: 2.306,
+              9: 2.262, 10: 2.228, 11: 2.201, 12: 2.179, 13: 2.160, 14: 2.145, 15: 2.131,
+              16: 2.120, 17: 2.110, 18: 2.101, 19: 2.093, 20: 2.086, 21: 2.080, 22: 2.074,
+              23: 2.069, 24: 2.064, 25: 2.060, 26: 2.056, 27: 2.052, 28: 2.048, 29: 2.045, 30: 2.042}
+
+t_99_table = {2: 9.925, 3: 5.841, 4: 4.604, 5: 4.032, 6: 3.707, 7: 3.499, 8: 3.355,
+              9: 3.250, 10: 3.169, 11: 3.106, 12: 3.055, 13: 3.012, 14: 2.977, 15: 2.947,
+              16: 2.921, 17: 2.898, 18: 2.878, 19: 2.861, 20: 2.845, 21: 2.831, 22: 2.819,
+              23: 2.807, 24: 2.797, 25: 2.787, 26: 2.779, 27: 2.771, 28: 2.763, 29: 2.756, 30: 2.750}
+
+t_tables = {90: t_90_table, 95: t_95_table, 99: t_99_table}
+
+# Confidence level of the Critical flag, also the what-if explorer's starting point
+critical_confidence_level = 95
+
+# Warehouse order
+warehouses = {'G_Active_1': 11, 'G_Active_2': 12, 'G_MD_1': 13, 'G_MD_2': 14, 
+              'HGBU_Extra': 18, 'Pre_Ship_1': 15, 'Pre_Ship_2': 16, 'WIPLines1': 9, 
+              'WIPLines2': 10, 'WIP_Cut_1': 2, 'WIP_Emb_1': 17, 'WIP_P1': 4, 
+              'WIP_Pri_1': 3, 'WIP_Sew_1': 5, 'WIP_Sew_2': 6, 'WIP_Sew_P1': 7, 
+              'WIP_Sew_P2': 8, 'PF_Active': 1}
+
+# Process one pair of uploaded files into the data used by the dashboard.
+# report(stage, progress, **results) is called as each stage starts, with any results already final.
+def process_snapshot(stock_source_file, fabric_stock_file, report=lambda stage, progress, **results: None):
+    # Read files
+    report("Reading files", 0.0)
+    df = pd.read_excel(stock_source_file, engine='openpyxl', sheet_name='Sheet')
+    report("Reading files", 0.2)
+    df2 = pd.read_excel(fabric_stock_file, engine='openpyxl', sheet_name='Sheet')
     
-    # Display current date
-    st.info(f"Analysis Date: {current_date}")
+    # Extract current date from fabric stock filename
+    fabric_filename = fabric_stock_file.name
+    try:
+        date_part = fabric_filename.split('stock')[1].split('.')[0].strip()
+        current_date = date_part.replace(' ', '-')
+    except:
+        current_date = datetime.now().strftime('%d-%m-%Y')
+    
+    # Aggregate by Warehouse
+    report("Totalling warehouses", 0.4)
+    df_group1 = df.groupby('Warehouse')['Quantity'].sum().reset_index()
+    df2["one"] = 1
+    df_group2 = df2.groupby('Ware House')['one'].sum().reset_index()
+    
+    # Add PF_Active row
+    df_group1 = pd.concat([df_group1, df_group2[df_group2['Ware House'] == 'PF_Active'].rename(columns={'Ware House': 'Warehouse', 'one': 'Quantity'})], ignore_index=True)
+    df_grouped = df_group1
+    
+    df_grouped['Order'] = df_grouped['Warehouse'].map(warehouses)
+    df_grouped = df_grouped.sort_values(by='Order').reset_index(drop=True)
+    
+    # Calculate number of days
+    report("Calculating aging", 0.5, df_grouped=df_grouped, current_date=current_date)
+    df["number of days"] = (pd.to_datetime(current_date, format='%d-%m-%Y') - pd.to_datetime(df['Last Movement Date'], format='%d-%m-%Y')).dt.days
+    df2["number of days"] = (pd.to_datetime(current_date, format='%d-%m-%Y') - pd.to_datetime(df2['last transaction date'], format='%d-%m-%Y')).dt.days
+    
+    # Days categories
+    df["days cat"] = pd.cut(df["number of days"], bins=days_bins, labels=days_labels)
+    df2["days cat"] = pd.cut(df2["number of days"], bins=days_bins, labels=days_labels)
+    
+    # Statistical significance
+    report("Finding critical items", 0.6)
+    statistical_sig = {}
+    for i in df["Warehouse"].unique():
+        temp_df = df[df["Warehouse"] == i]
+        mean = temp_df["number of days"].mean()
+        sigma = temp_df["number of days"].std()
+        if len(temp_df) > 30:
+            CI_pos = mean + z_values[critical_confidence_level] * (sigma / np.sqrt(len(temp_df)))
+        else:
+            CI_pos = mean + t_tables[critical_confidence_level][len(temp_df)] * (sigma / np.sqrt(len(temp_df)))
+        statistical_sig[i] = CI_pos
+    
+    statistical_sig2 = {}
+    for i in df2["Ware House"].unique():
+        temp_df = df2[df2["Ware House"] == i]
+        mean = temp_df["number of days"].mean()
+        sigma = temp_df["number of days"].std()
+        if len(temp_df) > 30:
+            CI_pos = mean + z_values[critical_confidence_level] * (sigma / np.sqrt(len(temp_df)))
+        else:
+            CI_pos = mean + t_tables[critical_confidence_level][len(temp_df)] * (sigma / np.sqrt(len(temp_df)))
+        statistical_sig2[i] = CI_pos
+    
+    df["Critical"] = df["number of days"] > df["Warehouse"].map(statistical_sig)
+    df2["Critical"] = df2["number of days"] > df2["Ware House"].map(statistical_sig2)
     
-    # Cards for total quantities by warehouse
+    # Sorted age arrays per warehouse for the what-if explorer: any threshold or
+    # bucket edge is then answered with np.searchsorted on 'days' and a lookup in 'cum_qty'
+    age_sources = [(i, temp_df["number of days"], temp_df["Quantity"]) for i, temp_df in df.groupby('Warehouse')]
+    if 'PF_Active' in df2['Ware House'].unique():
+        pf_df = df2[df2['Ware House'] == 'PF_Active']
+        age_sources.append(('PF_Active', pf_df["number of days"], pf_df["one"]))
+    
+    age_index = {}
+    for i, days, qty in age_sources:
+        valid = days.notna().values
+        days_values = days.values[valid].astype(float)
+        qty_values = qty.values[valid].astype(float)
+        sort_order = np.argsort(days_values, kind='stable')
+        age_index[i] = {
+            'days': days_values[sort_order],
+            'cum_qty': np.concatenate([[0.0], np.cumsum(qty_values[sort_order])]),
+            'mean': days.mean(),
+            'sigma': days.std(),
+            'n': len(days)
+        }
+    age_index = dict(sorted(age_index.items(), key=lambda item: warehouses.get(item[0], len(warehouses) + 1)))
+    
+    # Pivot tables
+    report("Building pivot tables", 0.8)
+    pivot_table = pd.pivot_table(df, values='Quantity', index='Warehouse', columns='days cat', aggfunc='sum', fill_value=0)
+    pivot_table2 = pd.pivot_table(df2, values='one', index='Ware House', columns='days cat', aggfunc='sum', fill_value=0)
+    
+    pivot_table = pd.concat([pivot_table, pivot_table2.loc[['PF_Active']].rename(index={'PF_Active': 'PF_Active'})], axis=0).fillna(0)
+    pivot_table['Order'] = pivot_table.index.map(warehouses)
+    pivot_table = pivot_table.sort_values(by='Order').drop(columns=['Order'])
+    
+    # Time category totals
+    time_cat_totals = df.groupby('days cat')['Quantity'].sum().reset_index()
+    
+    # Critical totals
+    report("Totalling critical items", 0.9, pivot_table=pivot_table, time_cat_totals=time_cat_totals)
+    crucial_totals = df[df['Critical']].groupby('Warehouse')['Quantity'].sum().reset_index()
+    
+    # Add PF_Active critical totals from df2
+    if 'PF_Active' in df2['Ware House'].unique():
+        pf_critical = df2[(df2['Ware House'] == 'PF_Active') & (df2['Critical'])].groupby('Ware House')['one'].sum().reset_index()
+        if not pf_critical.empty:
+            pf_critical.columns = ['Warehouse', 'Quantity']
+            crucial_totals = pd.concat([crucial_totals, pf_critical], ignore_index=True)
+    
+    crucial_totals['Order'] = crucial_totals['Warehouse'].map(warehouses)
+    crucial_totals = crucial_totals.sort_values(by='Order').drop(columns=['Order']).reset_index(drop=True)
+    
+    return {
+        'df': df,
+        'df2': df2,
+        'df_grouped': df_grouped,
+        'pivot_table': pivot_table,
+        'time_cat_totals': time_cat_totals,
+        'crucial_totals': crucial_totals,
+        'age_index': age_index,
+        'current_date': current_date
+    }
+
+# Composite keys used to match lines between two snapshots
+stock_key_columns = ['Project', 'Color', 'Size']
+fabric_key_columns = ['Project', 'Lot No']
+
+# One key value as text: whole numbers lose the float part Excel may give them (38 and 38.0 become "38"),
+# text is only stripped so lot numbers such as "000451" keep their leading zeros
+def key_value_text(value):
+    if isinstance(value, (float, np.floating)) and float(value).is_integer():
+        return str(int(value))
+    if isinstance(value, (int, np.integer)):
+        return str(int(value))
+    return str(value).strip()
+
+# Key column as text that does not depend on the dtype Excel gave it, blanks become ""
+def key_text(column):
+    codes, uniques = pd.factorize(column)
+    text = [key_value_text(value) for value in uniques]
+    # factorize codes blanks as -1, which picks the trailing ""
+    return pd.Series(np.array(text + [''], dtype=object)[codes], index=column.index)
+
+# Hash (warehouse + key columns) per row and total the rows of each key.
+# Returns the per-key totals and the readable key columns, both indexed by the hash.
+def snapshot_lines(data, warehouse_column, key_columns, quantity_column):
+    ids = data[[warehouse_column] + key_columns].rename(columns={warehouse_column: 'Warehouse'})
+    key_values = ids.apply(key_text)
+    ids.index = pd.Index(pd.util.hash_pandas_object(key_values, index=False).values, name='key')
+    
+    lines = pd.DataFrame({
+        'Quantity': data[quantity_column].values,
+        'number of days': data['number of days'].values,
+        'Critical': data['Critical'].values
+    }, index=ids.index)
+    lines = lines.groupby(level='key').agg({'Quantity': 'sum', 'number of days': 'max', 'Critical': 'any'})
+    return lines, ids
+
+# Align two snapshots on the union of their hashed keys and flag what left, arrived, turned critical or changed bucket
+def compare_lines(previous, current):
+    previous_lines, previous_ids = previous
+    current_lines, current_ids = current
+    keys = previous_lines.index.union(current_lines.index)
+    
+    ids = pd.concat([current_ids, previous_ids])
+    ids = ids[~ids.index.duplicated()].reindex(keys)
+    merged = pd.concat([ids,
+                        previous_lines.reindex(keys).add_suffix(' Previous'),
+                        current_lines.reindex(keys).add_suffix(' Current')], axis=1)
+    merged['days cat Previous'] = pd.cut(merged['number of days Previous'], bins=days_bins, labels=days_labels)
+    merged['days cat Current'] = pd.cut(merged['number of days Current'], bins=days_bins, labels=days_labels)
+    
+    merged['Lines Previous'] = keys.isin(previous_lines.index)
+    merged['Lines Current'] = keys.isin(current_lines.index)
+    in_both = merged['Lines Previous'] & merged['Lines Current']
+    merged['Left'] = merged['Lines Previous'] & ~merged['Lines Current']
+    merged['New'] = merged['Lines Current'] & ~merged['Lines Previous']
+    merged['Newly Critical'] = in_both & merged['Critical Current'].eq(True) & merged['Critical Previous'].eq(False)
+    merged['Bucket Move'] = (in_both & merged['days cat Previous'].notna() & merged['days cat Current'].notna() &
+                             (merged['days cat Previous'] != merged['days cat Current']))
+    return merged.reset_index(drop=True)
+
+# Delta tables and per-warehouse movement summary between a previous and a current processed snapshot
+def compare_snapshots(previous, current):
+    stock_merged = compare_lines(snapshot_lines(previous['df'], 'Warehouse', stock_key_columns, 'Quantity'),
+                                 snapshot_lines(current['df'], 'Warehouse', stock_key_columns, 'Quantity'))
+    
+    previous_pf = previous['df2'][previous['df2']['Ware House'] == 'PF_Active']
+    current_pf = current['df2'][current['df2']['Ware House'] == 'PF_Active']
+    fabric_merged = compare_lines(snapshot_lines(previous_pf, 'Ware House', fabric_key_columns, 'one'),
+                                  snapshot_lines(current_pf, 'Ware House', fabric_key_columns, 'one'))
+    
+    # Per-warehouse movement summary
+    summary_columns = ['Warehouse', 'Lines Previous', 'Lines Current', 'Left', 'New', 'Newly Critical', 'Bucket Move',
+                       'Quantity Previous', 'Quantity Current']
+    summary = pd.concat([stock_merged[summary_columns], fabric_merged[summary_columns]], ignore_index=True)
+    summary = summary.fillna({'Quantity Previous': 0, 'Quantity Current': 0}).groupby('Warehouse').sum()
+    summary = summary.rename(columns={'Bucket Move': 'Bucket Moves'})
+    summary['Quantity Change'] = summary['Quantity Current'] - summary['Quantity Previous']
+    summary['Order'] = summary.index.map(warehouses)
+    summary = summary.sort_values(by='Order').drop(columns=['Order'])
+    
+    # Delta tables
+    stock_columns = ['Warehouse'] + stock_key_columns
+    left_lines = stock_merged[stock_merged['Left']][stock_columns + ['Quantity Previous', 'number of days Previous']]
+    newly_critical = stock_merged[stock_merged['Newly Critical']][stock_columns + ['Quantity Current', 'number of days Current']]
+    bucket_moves = stock_merged[stock_merged['Bucket Move']][stock_columns + ['Quantity Current', 'days cat Previous', 'days cat Current']]
+    pf_lots_remaining = fabric_merged[fabric_merged['Lines Previous'] & fabric_merged['Lines Current']][
+        fabric_key_columns + ['number of days Previous', 'number of days Current', 'days cat Current', 'Critical Current']
+    ].sort_values(by='number of days Current', ascending=False)
+    
+    return {
+        'summary': summary,
+        'left_lines': left_lines.reset_index(drop=True),
+        'newly_critical': newly_critical.reset_index(drop=True),
+        'bucket_moves': bucket_moves.reset_index(drop=True),
+        'pf_lots_remaining': pf_lots_remaining.reset_index(drop=True),
+        'previous_date': previous['current_date'],
+        'current_date': current['current_date']
+    }
+
+# Background processing jobs, shared by all sessions so a reloaded page can reattach by job id
+@st.cache_resource
+def get_processing_jobs():
+    return {}
+
+# Finished jobs the starting session has not released are kept this long, so a reload after completion still finds the results
+job_retention_seconds = 3600
+
+# Drop finished jobs that have outlived the retention period
+def prune_processing_jobs(processing_jobs):
+    for old_job_id, old_job in list(processing_jobs.items()):
+        if old_job['status'] != 'running' and time.time() - old_job['finished_at'] > job_retention_seconds:
+            processing_jobs.pop(old_job_id, None)
+
+# Raised from a cancelled job's progress report so its worker stops at the next stage
+class ProcessingCancelled(Exception):
+    pass
+
+# Run process_snapshot for a job in a worker thread, publishing progress and partial results on the job
+def run_processing_job(job, stock_source_file, fabric_stock_file):
+    def report(stage, progress, **results):
+        if job['cancelled']:
+            raise ProcessingCancelled()
+        job['results'].update(results)
+        job['stage'] = stage
+        job['progress'] = progress
+    
+    try:
+        job['results'].update(process_snapshot(stock_source_file, fabric_stock_file, report))
+        job['stage'] = "Done"
+        job['progress'] = 1.0
+        job['status'] = 'done'
+    except ProcessingCancelled:
+        # Nobody is waiting for this job any more, drop what it built so far
+        job['results'].clear()
+        job['status'] = 'cancelled'
+    except Exception as e:
+        job['error'] = str(e)
+        job['status'] = 'error'
+    job['finished_at'] = time.time()
+
+# Remove a job from the registry and tell its worker to stop
+def cancel_processing_job(processing_jobs, job_id):
+    job = processing_jobs.pop(job_id, None)
+    if job is not None:
+        job['cancelled'] = True
+
+# Start processing an upload in the background and return its job id
+def start_processing_job(stock_source_file, fabric_stock_file, upload_id):
+    processing_jobs = get_processing_jobs()
+    
+    # Copy the uploads so the worker does not depend on this session's upload objects
+    stock_source_copy = io.BytesIO(stock_source_file.getvalue())
+    fabric_stock_copy = io.BytesIO(fabric_stock_file.getvalue())
+    fabric_stock_copy.name = fabric_stock_file.name
+    
+    job_id = uuid.uuid4().hex
+    processing_jobs[job_id] = {
+        'status': 'running',
+        'stage': "Queued",
+        'progress': 0.0,
+        'results': {},
+        'error': None,
+        'upload_id': upload_id,
+        'cancelled': False,
+        'finished_at': None
+    }
+    threading.Thread(target=run_processing_job, args=(processing_jobs[job_id], stock_source_copy, fabric_stock_copy), daemon=True).start()
+    return job_id
+
+# What-if explorer: counts and quantities above a threshold and per custom bucket, answered from the
+# sorted age arrays. As a fragment, changing its widgets reruns only this function, not the whole dashboard.
+@st.fragment
+def show_whatif_explorer(age_index):
+    st.subheader("What-If Threshold Explorer")
+    max_age = int(max([index['days'][-1] for index in age_index.values() if len(index['days'])], default=0))
+    
+    col_whatif1, col_whatif2 = st.columns([1, 2])
+    with col_whatif1:
+        threshold_type = st.radio("Threshold Type", ["Confidence Level", "Age Cutoff"], horizontal=True)
+        if threshold_type == "Confidence Level":
+            confidence_level = st.select_slider("Confidence Level (%)", options=list(z_values.keys()), value=critical_confidence_level)
+        else:
+            age_cutoff = st.slider("Age Cutoff (days)", min_value=0, max_value=max(max_age, 1), value=min(60, max(max_age, 1)))
+    
+        bucket_edges_text = st.text_input("Bucket Edges (days)", value=", ".join(str(edge) for edge in days_bins[1:-1]))
+        try:
+            bucket_edges = sorted(set(int(edge) for edge in bucket_edges_text.split(',') if edge.strip()))
+        except ValueError:
+            bucket_edges = []
+        if not bucket_edges or bucket_edges[0] < 0:
+            st.warning("Bucket edges must be non-negative whole numbers separated by commas. Using default edges.")
+            bucket_edges = days_bins[1:-1]
+    
+    # Items above the threshold per warehouse
+    whatif_rows = []
+    for warehouse, index in age_index.items():
+        if threshold_type == "Confidence Level":
+            n = index['n']
+            critical_value = z_values[confidence_level] if n > 30 else t_tables[confidence_level][n]
+            threshold = index['mean'] + critical_value * (index['sigma'] / np.sqrt(n))
+        else:
+            threshold = age_cutoff
+        position = np.searchsorted(index['days'], threshold, side='right')
+        whatif_rows.append({
+            'Warehouse': warehouse,
+            'Threshold (days)': round(float(threshold), 1),
+            'Items Above': len(index['days']) - int(position),
+            'Quantity Above': index['cum_qty'][-1] - index['cum_qty'][position]
+        })
+    whatif_totals = pd.DataFrame(whatif_rows)
+    
+    # Items and quantity per custom bucket, same right-closed edges as pd.cut
+    bucket_labels = ([f"0 - {bucket_edges[0]} days"] +
+                     [f"{low + 1} - {high} days" for low, high in zip(bucket_edges[:-1], bucket_edges[1:])] +
+                     [f"{bucket_edges[-1]}+ days"])
+    bucket_counts = {}
+    bucket_quantities = {}
+    for warehouse, index in age_index.items():
+        positions = np.concatenate([[0], np.searchsorted(index['days'], bucket_edges, side='right'), [len(index['days'])]])
+        bucket_counts[warehouse] = np.diff(positions)
+        bucket_quantities[warehouse] = np.diff(index['cum_qty'][positions])
+    whatif_counts = pd.DataFrame.from_dict(bucket_counts, orient='index', columns=bucket_labels)
+    whatif_pivot = pd.DataFrame.from_dict(bucket_quantities, orient='index', columns=bucket_labels)
+    
+    with col_whatif2:
+        st.dataframe(whatif_totals, use_container_width=True, hide_index=True)
+    tab_counts, tab_quantities = st.tabs(["Items per Bucket", "Quantity per Bucket"])
+    with tab_counts:
+        st.dataframe(whatif_counts, use_container_width=True)
+    with tab_quantities:
+        st.dataframe(whatif_pivot, use_container_width=True)
+
+# Cards for total quantities by warehouse, top 3 highlighted
+def show_warehouse_cards(df_grouped):
     st.subheader("Total Quantity by Warehouse")
     qty_sorted = df_grouped.sort_values(by='Quantity', ascending=False).reset_index(drop=True)
     qty_sorted['Rank'] = qty_sorted.index + 1
@@ -186,6 +447,66 @@ if st.session_state.processed:
                     <p style="margin: 5px 0 0 0; font-size: 20px; font-weight: bold; color: #2c3e50;">{int(row['Quantity']):,}</p>
                 </div>
                 """, unsafe_allow_html=True)
+
+# Title
+st.title("Warehouse Stock Analysis Dashboard")
+
+# File upload section
+col1, col2 = st.columns(2)
+with col1:
+    stock_source_file = st.file_uploader("Upload Stock Source File", type=['xlsx'])
+with col2:
+    fabric_stock_file = st.file_uploader("Upload Fabric Stock File", type=['xlsx'])
+
+# Reattach to this session's processing job, or to the one in the URL after a page reload.
+# Only a job this session started is ever cancelled or released by it: a job URL shared
+# with another planner must not take the job away from the session that started it.
+processing_jobs = get_processing_jobs()
+prune_processing_jobs(processing_jobs)
+own_job = 'job_id' in st.session_state
+job_id = st.session_state.job_id if own_job else st.query_params.get('job')
+job = processing_jobs.get(job_id)
+
+# Process data in the background when files are uploaded, restarting when either file is replaced
+if stock_source_file and fabric_stock_file and not st.session_state.processed:
+    upload_id = (stock_source_file.file_id, fabric_stock_file.file_id)
+    if job is None or job['upload_id'] != upload_id:
+        if own_job:
+            cancel_processing_job(processing_jobs, job_id)
+        own_job = True
+        job_id = start_processing_job(stock_source_file, fabric_stock_file, upload_id)
+        job = processing_jobs[job_id]
+        st.session_state.job_id = job_id
+        st.query_params['job'] = job_id
+
+# Read the status once so this run renders a consistent view while the worker keeps going
+job_status = job['status'] if job is not None else None
+
+# Store in session state once the job is done; the session owns the results from here,
+# so release its own job and the frames instead of keeping them for reattaching
+if job_status == 'done' and not st.session_state.processed:
+    for key, value in job['results'].items():
+        st.session_state[key] = value
+    if own_job:
+        processing_jobs.pop(job_id, None)
+    st.session_state.pop('job_id', None)
+    st.query_params.pop('job', None)
+    st.session_state.processed = True
+
+# Main dashboard
+if st.session_state.processed:
+    df = st.session_state.df
+    df2 = st.session_state.df2
+    df_grouped = st.session_state.df_grouped
+    pivot_table = st.session_state.pivot_table
+    time_cat_totals = st.session_state.time_cat_totals
+    crucial_totals = st.session_state.crucial_totals
+    current_date = st.session_state.current_date
+    
+    # Display current date
+    st.info(f"Analysis Date: {current_date}")
+    
+    show_warehouse_cards(df_grouped)
     
     # Bar chart
     st.subheader("Total Quantity Distribution")
@@ -202,6 +523,9 @@ if st.session_state.processed:
     st.subheader("Quantity Distribution by Time Category")
     st.dataframe(pivot_table, use_container_width=True)
     
+    # What-if threshold explorer
+    show_whatif_explorer(st.session_state.age_index)
+    
     # Sidebar filters
     st.sidebar.header("Filters")
     filter_type = st.sidebar.radio("Filter Type", ["Days", "Statistical"])
@@ -236,8 +560,7 @@ if st.session_state.processed:
                 """, unsafe_allow_html=True)
             
             # Days category filter
-            days_categories = ["0 - 15 days", "16 - 30 days", "31 - 60 days", "61 - 90 days", "91 - 180 days", "180+ days"]
-            selected_days = st.multiselect("Select Days Categories", days_categories, default=days_categories)
+            selected_days = st.multiselect("Select Days Categories", days_labels, default=days_labels)
             
         else:  # Statistical
             st.subheader("Critical Items Summary")
@@ -417,10 +740,72 @@ if st.session_state.processed:
     # Reset button
     st.sidebar.markdown("---")
     if st.sidebar.button("🔄 Reset and Upload New Files"):
+        st.query_params.clear()
         for key in st.session_state.keys():
             del st.session_state[key]
         st.rerun()
     
+    # Snapshot comparison
+    st.markdown("---")
+    st.header("🔁 Compare with Previous Snapshot")
+    
+    col_prev1, col_prev2 = st.columns(2)
+    with col_prev1:
+        previous_stock_file = st.file_uploader("Upload Previous Stock Source File", type=['xlsx'])
+    with col_prev2:
+        previous_fabric_file = st.file_uploader("Upload Previous Fabric Stock File", type=['xlsx'])
+    
+    comparison = None
+    if previous_stock_file and previous_fabric_file:
+        previous_files = (previous_stock_file.file_id, previous_fabric_file.file_id)
+        if st.session_state.get('comparison_files') != previous_files:
+            with st.spinner("Comparing snapshots..."):
+                # A failure is kept for these files too, so a bad workbook is not reprocessed on every rerun
+                try:
+                    previous_snapshot = process_snapshot(previous_stock_file, previous_fabric_file)
+                    current_snapshot = {'df': df, 'df2': df2, 'current_date': current_date}
+                    st.session_state.snapshot_comparison = compare_snapshots(previous_snapshot, current_snapshot)
+                    st.session_state.comparison_error = None
+                except Exception as e:
+                    st.session_state.snapshot_comparison = None
+                    st.session_state.comparison_error = str(e)
+                st.session_state.comparison_files = previous_files
+        
+        comparison = st.session_state.snapshot_comparison
+        if comparison is None:
+            st.error(f"❌ Failed to compare snapshots: {st.session_state.comparison_error}\n\nPlease check the previous files and upload them again.")
+    
+    if comparison is not None:
+        st.info(f"Comparing {comparison['previous_date']} with {comparison['current_date']}")
+        
+        st.subheader("Movement Summary by Warehouse")
+        st.dataframe(comparison['summary'], use_container_width=True)
+        
+        comparison_tables = [
+            ("Left Warehouse", 'left_lines', "Left_Warehouse"),
+            ("Newly Critical", 'newly_critical', "Newly_Critical"),
+            ("Bucket Moves", 'bucket_moves', "Bucket_Moves"),
+            ("PF_Active Lots Still in Stock", 'pf_lots_remaining', "PF_Active_Remaining_Lots")
+        ]
+        comparison_tabs = st.tabs([tab_label for tab_label, _, _ in comparison_tables])
+        for tab, (tab_label, table_key, file_label) in zip(comparison_tabs, comparison_tables):
+            with tab:
+                table = comparison[table_key]
+                if not table.empty:
+                    st.dataframe(table, use_container_width=True, height=400)
+                    
+                    # Download button
+                    csv = table.to_csv(index=False).encode('utf-8')
+                    st.download_button(
+                        label="📥 Download Changes",
+                        data=csv,
+                        file_name=f"{file_label}_{comparison['previous_date']}_to_{comparison['current_date']}.csv",
+                        mime="text/csv",
+                        key=f"download_{table_key}"
+                    )
+                else:
+                    st.info("No items found.")
+    
     # Email Section
     st.markdown("---")
     st.header("📧 Send Email Report")
@@ -742,5 +1127,27 @@ Planning Department
                 except Exception as e:
                     st.error(f"❌ Failed to send email: {str(e)}\n\nPlease check your credentials and try again.")
 
+elif job_status == 'running':
+    # Progress and early results while the background job runs
+    st.progress(job['progress'], text=f"Processing data... {job['stage']}")
+    partial_results = job['results']
+    if 'df_grouped' in partial_results:
+        st.info(f"Analysis Date: {partial_results['current_date']}")
+        show_warehouse_cards(partial_results['df_grouped'])
+    if 'pivot_table' in partial_results:
+        st.subheader("Quantity Distribution by Time Category")
+        st.dataframe(partial_results['pivot_table'], use_container_width=True)
+    time.sleep(1)
+    st.rerun()
+
+elif job_status == 'error':
+    st.error(f"❌ Failed to process files: {job['error']}\n\nPlease check the files and upload them again.")
+    if st.button("🔄 Retry Processing"):
+        if own_job:
+            processing_jobs.pop(job_id, None)
+        st.session_state.pop('job_id', None)
+        st.query_params.clear()
+        st.rerun()
+
 else:
     st.info("Please upload both Stock Source and Fabric Stock files to begin analysis.")
\ No newline at end of file
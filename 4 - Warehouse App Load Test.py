@@ -0,0 +1,287 @@
+import argparse
+import io
+import os
+import pickle
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from datetime import datetime, timedelta
+
+import numpy as np
+import pandas as pd
+import psutil
+import streamlit
+from streamlit.runtime import Runtime
+from streamlit.runtime.scriptrunner.script_cache import ScriptCache
+from streamlit.testing.v1 import AppTest
+
+# Load test for the Warehouse Analysis Application: drives many simulated sessions through the real
+# script with Streamlit's in-process app testing API and reports rerun latency and server memory.
+#
+#   python "4 - Warehouse App Load Test.py" --sessions 1 10 20 50 --rows 5000 50000
+#
+# Every session uploads its own synthetic workbooks, then repeats a round of dashboard interactions.
+# Each scenario runs in a fresh process so its memory figures do not include earlier scenarios.
+
+APP_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "2 - Warehouse Analysis Application.py")
+XLSX_MIME = "application/vnd.openxmlformats-officedocument.spreadsheetml.sheet"
+
+# prepare_concurrent_sessions patches Streamlit internals that change between releases,
+# so the harness only runs on the version it was written and checked against
+TESTED_STREAMLIT_VERSION = "1.66.0"
+
+# Warehouses of the Stock Source file (PF_Active comes from the Fabric Stock file)
+stock_warehouses = ['G_Active_1', 'G_Active_2', 'G_MD_1', 'G_MD_2', 'HGBU_Extra', 'Pre_Ship_1', 'Pre_Ship_2',
+                    'WIPLines1', 'WIPLines2', 'WIP_Cut_1', 'WIP_Emb_1', 'WIP_P1', 'WIP_Pri_1',
+                    'WIP_Sew_1', 'WIP_Sew_2', 'WIP_Sew_P1', 'WIP_Sew_P2']
+fabric_warehouses = ['PF_Active', 'PF_Quarantine']
+
+# Percentiles reported for every action
+percentiles = [50, 95, 99]
+
+
+# Synthetic Stock Source and Fabric Stock workbooks as uploader tuples (filename, content, mime type)
+def make_workbooks(rows, analysis_date, seed=0):
+    rng = np.random.default_rng(seed)
+
+    stock_days = rng.gamma(shape=1.5, scale=60, size=rows).astype(int)
+    stock_df = pd.DataFrame({
+        'Project': [f"PRJ-{number:05d}" for number in rng.integers(0, max(rows // 20, 10), rows)],
+        'Color': rng.choice(['Black', 'White', 'Navy', 'Red', 'Grey'], rows),
+        'Size': rng.choice(['XS', 'S', 'M', 'L', 'XL'], rows),
+        'Quantity': rng.integers(1, 500, rows),
+        'Customer': rng.choice(['Customer A', 'Customer B', 'Customer C'], rows),
+        'Warehouse': rng.choice(stock_warehouses, rows),
+        'Last Movement Date': [(analysis_date - timedelta(days=int(days))).strftime('%d-%m-%Y') for days in stock_days]
+    })
+
+    fabric_rows = max(rows // 5, 100)
+    fabric_days = rng.gamma(shape=1.5, scale=80, size=fabric_rows).astype(int)
+    fabric_df = pd.DataFrame({
+        'Project': [f"PRJ-{number:05d}" for number in rng.integers(0, max(rows // 20, 10), fabric_rows)],
+        'Lot No': [f"LOT-{number:07d}" for number in rng.integers(0, fabric_rows * 10, fabric_rows)],
+        'Style-color': rng.choice(['ST1-Black', 'ST2-Navy', 'ST3-White'], fabric_rows),
+        'Gramaj': rng.choice([140, 160, 180, 220], fabric_rows),
+        'Ware House': rng.choice(fabric_warehouses, fabric_rows, p=[0.8, 0.2]),
+        'last transaction date': [(analysis_date - timedelta(days=int(days))).strftime('%d-%m-%Y') for days in fabric_days]
+    })
+
+    workbooks = []
+    for filename, frame in [("Stock Source.xlsx", stock_df),
+                            (f"Fabric stock {analysis_date.strftime('%d %m %Y')}.xlsx", fabric_df)]:
+        buffer = io.BytesIO()
+        with pd.ExcelWriter(buffer, engine='openpyxl') as writer:
+            frame.to_excel(writer, sheet_name='Sheet', index=False)
+        workbooks.append((filename, buffer.getvalue(), XLSX_MIME))
+    return workbooks
+
+
+# AppTest assumes one app per process. Two adjustments let sessions run concurrently, as on a real server:
+# - each run installs a mock Runtime and clears it afterwards, so keep the last one for runs still in flight
+# - each run compiles the script into a fresh ScriptCache (concurrent ast.parse is unsafe on Python 3.11),
+#   so share one cache across sessions like the server does
+def prepare_concurrent_sessions():
+    last_runtime = {}
+
+    def instance(cls):
+        if cls._instance is not None:
+            last_runtime['runtime'] = cls._instance
+            return cls._instance
+        if 'runtime' in last_runtime:
+            return last_runtime['runtime']
+        raise RuntimeError("Runtime hasn't been created!")
+
+    def exists(cls):
+        return cls._instance is not None or 'runtime' in last_runtime
+
+    Runtime.instance = classmethod(instance)
+    Runtime.exists = classmethod(exists)
+
+    shared_script_cache = ScriptCache()
+    get_bytecode = ScriptCache.get_bytecode
+    ScriptCache.get_bytecode = lambda self, script_path: get_bytecode(shared_script_cache, script_path)
+
+
+# Current resident set size of this process in MB
+def current_rss_mb():
+    return psutil.Process().memory_info().rss / (1024 * 1024)
+
+
+# Sample RSS in the background until stopped, keeping the peak
+class RssSampler(threading.Thread):
+    def __init__(self, interval=0.2):
+        super().__init__(daemon=True)
+        self.interval = interval
+        self.peak_mb = current_rss_mb()
+        self.stopped = threading.Event()
+
+    def run(self):
+        while not self.stopped.wait(self.interval):
+            self.peak_mb = max(self.peak_mb, current_rss_mb())
+
+    def stop(self):
+        self.stopped.set()
+        self.join()
+        self.peak_mb = max(self.peak_mb, current_rss_mb())
+        return self.peak_mb
+
+
+# First widget of a kind with the given label
+def find_widget(widgets, label):
+    for widget in widgets:
+        if widget.label == label:
+            return widget
+    raise LookupError(f"No widget labelled {label!r}")
+
+
+# One planner: upload, then repeat filter switches, warehouse selection, ZIP export and email preview
+def run_session(workbooks, rounds, start_barrier, latencies, errors, timeout):
+    def timed(action, app_test):
+        started = time.perf_counter()
+        app_test.run(timeout=timeout)
+        latencies.append((action, time.perf_counter() - started))
+        for exception in app_test.exception:
+            errors.append(f"{action}: {exception.value}")
+
+    at = AppTest.from_file(APP_PATH, default_timeout=timeout)
+    try:
+        timed("initial load", at)
+
+        start_barrier.wait()
+        at.file_uploader[0].set_value(workbooks[0])
+        at.file_uploader[1].set_value(workbooks[1])
+        # One timing from the upload until the dashboard shows: background processing plus every
+        # one-second progress poll of the app, not the latency of a single rerun
+        timed("upload to dashboard (end-to-end)", at)
+
+        warehouse_options = find_widget(at.sidebar.selectbox, "Select Warehouse").options
+        department_options = find_widget(at.selectbox, "Select Department").options
+        for round_number in range(rounds):
+            find_widget(at.sidebar.radio, "Filter Type").set_value("Statistical")
+            timed("filter statistical", at)
+
+            warehouse = warehouse_options[1 + round_number % (len(warehouse_options) - 1)]
+            find_widget(at.sidebar.selectbox, "Select Warehouse").set_value(warehouse)
+            timed("select warehouse", at)
+
+            find_widget(at.sidebar.radio, "Filter Type").set_value("Days")
+            timed("filter days", at)
+
+            find_widget(at.sidebar.button, "📦 Download All Warehouses (ZIP)").click()
+            timed("zip export", at)
+
+            department = department_options[round_number % len(department_options)]
+            find_widget(at.selectbox, "Select Department").set_value(department)
+            timed("email preview", at)
+
+            find_widget(at.sidebar.selectbox, "Select Warehouse").set_value("All")
+            timed("select all warehouses", at)
+    except threading.BrokenBarrierError:
+        errors.append("session: start barrier broken, another session failed or timed out before upload")
+    except Exception as e:
+        # Release the sessions waiting for this one at the start barrier
+        start_barrier.abort()
+        errors.append(f"session: {e!r}")
+    return at
+
+
+# Run one concurrency level against one data size and summarise latencies per action
+def run_scenario(workbooks, rows, sessions, rounds, timeout):
+    latencies, errors = [], []
+    start_barrier = threading.Barrier(sessions, timeout=timeout)
+    app_tests = []
+
+    rss_start_mb = current_rss_mb()
+    sampler = RssSampler()
+    sampler.start()
+    started = time.perf_counter()
+
+    threads = [threading.Thread(target=lambda: app_tests.append(run_session(workbooks, rounds, start_barrier,
+                                                                              latencies, errors, timeout)))
+               for _ in range(sessions)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    elapsed = time.perf_counter() - started
+    rss_peak_mb = sampler.stop()
+    rss_end_mb = current_rss_mb()
+
+    latency_df = pd.DataFrame(latencies, columns=['Action', 'Seconds'])
+    summary = latency_df.groupby('Action', sort=False)['Seconds'].agg(
+        ['count'] + [lambda seconds, p=p: np.percentile(seconds, p) for p in percentiles] + ['max'])
+    summary.columns = ['Reruns'] + [f"p{p} (s)" for p in percentiles] + ['max (s)']
+    summary = summary.reset_index()
+    summary.insert(0, 'Sessions', sessions)
+    summary.insert(0, 'Rows', rows)
+    summary['RSS start (MB)'] = round(rss_start_mb)
+    summary['RSS peak (MB)'] = round(rss_peak_mb)
+    summary['RSS end (MB)'] = round(rss_end_mb)
+    summary['RSS growth (MB)'] = round(rss_peak_mb - rss_start_mb)
+    summary['Wall time (s)'] = round(elapsed, 1)
+    summary['Errors'] = len(errors)
+    return summary, errors
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Concurrent-session load test for the Warehouse Analysis Application")
+    parser.add_argument('--sessions', type=int, nargs='+', default=[1, 5, 20, 50], help="concurrent sessions per scenario")
+    parser.add_argument('--rows', type=int, nargs='+', default=[2000, 20000], help="Stock Source rows per workbook")
+    parser.add_argument('--rounds', type=int, default=3, help="interaction rounds per session after upload")
+    parser.add_argument('--timeout', type=float, default=900, help="seconds allowed for a single rerun")
+    parser.add_argument('--seed', type=int, default=0, help="random seed for the synthetic workbooks")
+    parser.add_argument('--output', help="write the summary table to this CSV file")
+    parser.add_argument('--scenario', metavar='WORKBOOKS', help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if streamlit.__version__ != TESTED_STREAMLIT_VERSION:
+        sys.exit(f"The load test patches Streamlit internals and was checked against Streamlit {TESTED_STREAMLIT_VERSION}, "
+                 f"but {streamlit.__version__} is installed. Install streamlit=={TESTED_STREAMLIT_VERSION} to run it.")
+
+    # Child process: run a single scenario on pickled workbooks and write its summary to --output
+    if args.scenario:
+        with open(args.scenario, 'rb') as workbooks_file:
+            workbooks = pickle.load(workbooks_file)
+        prepare_concurrent_sessions()
+        summary, errors = run_scenario(workbooks, args.rows[0], args.sessions[0], args.rounds, args.timeout)
+        summary.to_csv(args.output, index=False)
+        for error in errors[:5]:
+            print(f"  ! {error}", flush=True)
+        return
+
+    analysis_date = datetime.now()
+
+    summaries = []
+    with tempfile.TemporaryDirectory() as work_dir:
+        for rows in args.rows:
+            print(f"Generating workbooks with {rows:,} stock rows...", flush=True)
+            workbooks_path = os.path.join(work_dir, f"workbooks_{rows}.pkl")
+            with open(workbooks_path, 'wb') as workbooks_file:
+                pickle.dump(make_workbooks(rows, analysis_date, seed=args.seed), workbooks_file)
+            for sessions in args.sessions:
+                print(f"Running {sessions} concurrent session(s) on {rows:,} rows...", flush=True)
+                summary_path = os.path.join(work_dir, f"summary_{rows}_{sessions}.csv")
+                scenario = subprocess.run([sys.executable, os.path.abspath(__file__), '--scenario', workbooks_path,
+                                           '--rows', str(rows), '--sessions', str(sessions), '--rounds', str(args.rounds),
+                                           '--timeout', str(args.timeout), '--output', summary_path])
+                if scenario.returncode != 0:
+                    print(f"  ! scenario process exited with code {scenario.returncode}", flush=True)
+                    continue
+                summaries.append(pd.read_csv(summary_path))
+
+    if not summaries:
+        print("No scenario completed.")
+        return
+    results = pd.concat(summaries, ignore_index=True)
+    with pd.option_context('display.max_rows', None, 'display.width', 200, 'display.float_format', '{:.3f}'.format):
+        print(results.to_string(index=False))
+    if args.output:
+        results.to_csv(args.output, index=False)
+        print(f"Summary written to {args.output}")
+
+
+if __name__ == '__main__':
+    main()